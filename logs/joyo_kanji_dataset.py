@@ -1,5 +1,7 @@
+from collections import OrderedDict
 import os
-import random
+import cv2
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import torch
 from library.train_util import ImageInfo, MinimalDataset
@@ -44,10 +46,22 @@ class JoyoKanjiDataset(MinimalDataset):
         "handwritten simple",
     ]
 
+    # キャプションの前置詞と冠詞、およびその確率 / prepositions and articles in captions, and their probabilities
+    PREPOSITIONS = ["by", "with", "in"]
+    PREPOSITION_PROBS = [0.33, 0.335, 0.335]
+    ARTICLES = ["", "the"]
+
     # 学習用パラメータ / training parameters
     BATCH_SIZE = 64  # 引数で指定したいけど今のところここに書くしかない / We want to specify it as an argument, but for now we have to write it here.
     SEED = 42
 
+    # トークンIDをキャッシュするキャプション数の上限 / maximum number of captions to cache token IDs for
+    TOKEN_CACHE_SIZE = 65536
+
+    # 文字を描画する解像度の倍率、学習時の解像度のこの倍で描画して縮小する。上げると起動時の描画時間が2乗で増える
+    # scale factor to render letters, letters are rendered at this multiple of the training resolution and downscaled. startup time grows with its square
+    RENDER_SCALE = 2
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         assert self.width == self.height, "width and height must be the same"
@@ -61,6 +75,11 @@ class JoyoKanjiDataset(MinimalDataset):
                 for c in line:
                     letters.add(c)
         self._letters = sorted(list(letters))
+        self._letters_arr = np.array(self._letters)  # まとめて取り出すため / for vectorized lookup
+
+        # 描画する解像度、縮小率が整数になるように学習時の解像度の整数倍にする / resolution to render, an integer multiple of the training resolution so that the downscale factor is an integer
+        self._render_scale = JoyoKanjiDataset.RENDER_SCALE
+        self._render_size = self.width * self._render_scale
 
         # prepare fonts
         self._fonts: ImageFont = []
@@ -68,17 +87,91 @@ class JoyoKanjiDataset(MinimalDataset):
         for font_file in JoyoKanjiDataset.FONT_FILES:
             # フォントファイルが存在するか確認し読み込む / Check if the font file exists and read it
             assert os.path.exists(font_file), f"font file {font_file} does not exist"
-            font = ImageFont.truetype(font_file, self.width * 4 // 5)
+            font = ImageFont.truetype(font_file, self._render_size * 4 // 5)
             self._fonts.append(font)
 
             # 文字を上下中央に配置するためのオフセットを計算 / Calculate the offset to place the character in the center vertically
-            # ascent, descent = font.getmetrics()
-            # (width, baseline), (offset_x, offset_y) = font.font.getsize(text)
-            _, (_, offset_y) = font.font.getsize("亜")
+            # getbboxは (offset_x, offset_y, offset_x + width, offset_y + height) を返す / getbbox returns (offset_x, offset_y, offset_x + width, offset_y + height)
+            _, offset_y, _, _ = font.getbbox("亜")
             self._font_offsets.append(offset_y)
 
+        # キャプションの断片を事前に作っておく / prepare caption fragments in advance
+        # [preposition_index][font_index] -> "by pop" etc., [article_index] -> "the letter " etc.
+        self._font_fragments = [
+            [f"{preposition} {font_name}" for font_name in JoyoKanjiDataset.FONT_NAMES] for preposition in JoyoKanjiDataset.PREPOSITIONS
+        ]
+        self._letter_fragments = [f"{article} letter " for article in JoyoKanjiDataset.ARTICLES] # characterのほうがいいかも…… / character might be better...
+
+        # 文字を中央に描画するための位置を全ての文字とフォントについて事前に計算しておく、描画する解像度での値
+        # precompute the position to draw each letter in the center for all letters and fonts, in the render resolution
+        self._draw_origins = np.zeros((len(self._letters), len(self._fonts), 2), dtype=np.int16)
+        # textsizeはPillow 10で削除されたので、getbboxから同じ値を計算する: width = right - left, height = bottom
+        # textsize was removed in Pillow 10, so calculate the same value from getbbox: width = right - left, height = bottom
+        for font_index, (font, y_offset) in enumerate(zip(self._fonts, self._font_offsets)):
+            for letter_index, letter in enumerate(self._letters):
+                left, _, right, bottom = font.getbbox(letter)
+                text_size = (right - left, bottom)
+                self._draw_origins[letter_index, font_index] = (
+                    (self._render_size - text_size[0]) // 2,
+                    (self._render_size - text_size[1] + y_offset) // 2 - y_offset,
+                )
+
+        # 全ての文字とフォントの組み合わせについて文字画像を事前に描画しておく
+        # 文字のある範囲だけを1つの連続したuint8の配列に詰め、(offset, y, x, h, w) の表で引く
+        # DataLoaderのworkerをforkで作る場合は書き込まないのでコピーされずに共有される (Windowsのspawnではworkerごとにコピーされる)
+        # 時間とメモリは文字数×フォント数に比例する、常用漢字2136文字×13フォントで512x512なら約2GB、1〜2分程度
+        # render the letter images for all combinations of letters and fonts in advance
+        # only the area with the letter is packed into one contiguous uint8 array, looked up by an (offset, y, x, h, w) table
+        # when DataLoader workers are forked, the array is never written so it is shared without copying (with spawn on Windows, each worker gets a copy)
+        # time and memory are proportional to letters x fonts, about 2GB and a minute or two for 2136 Joyo kanji x 13 fonts at 512x512
+        print(f"JoyoKanjiDataset: rendering {len(self._letters) * len(self._fonts)} letter images")
+        self._glyph_table = np.zeros((len(self._letters), len(self._fonts), 5), dtype=np.int64)
+        glyph_masks = []
+        offset = 0
+        for letter_index in range(len(self._letters)):
+            for font_index in range(len(self._fonts)):
+                mask, (x, y) = self._render_glyph(letter_index, font_index)
+                h, w = mask.shape
+                self._glyph_table[letter_index, font_index] = (offset, y, x, h, w)
+                glyph_masks.append(mask.ravel())
+                offset += mask.size
+        self._glyph_masks = np.concatenate(glyph_masks)
+        del glyph_masks
+        print(f"JoyoKanjiDataset: letter images use {self._glyph_masks.nbytes / 1024**2:.1f} MB")
+
+        # バッチ全体の画像バッファ (B, H, W)、毎回確保せずに使い回す / image buffer for the whole batch (B, H, W), reused instead of allocating each time
+        # 画素値ではなく文字の濃さ (背景は0) を持ち、Tensorへの変換時に白地に黒の3チャンネルの画像にする
+        # holds the coverage of the letter (0 for background) instead of pixel values, converted to 3-channel black on white when converting to Tensor
+        # DataLoaderのプロセスごとに別のインスタンスになるのでロックは不要 / each DataLoader process has its own instance, so no lock is needed
+        self._batch_buffer = None
+        # 前回文字を描いた範囲 (y, x, h, w)、次のバッチではそこだけ消す / area where the letter was drawn last time (y, x, h, w), only that is cleared for the next batch
+        self._batch_regions = [None] * JoyoKanjiDataset.BATCH_SIZE
+
+        # 1.0がデフォルトだが他の値を設定して重みづけを変えることもできる。数はバッチサイズと同じにすること
+        # 1.0 is the default, but you can also set other values to change the weighting. The number should be the same as the batch size.
+        # 値は変わらないので一度だけ作る、学習側ではin-placeで変更されない / the value never changes so create it once, it is not modified in-place in training
+        self._loss_weights = torch.ones(JoyoKanjiDataset.BATCH_SIZE, dtype=torch.float32)
+
+        # 返り値のdictのひな形、バッチごとに変わらない値は先に入れておく / template of the returned dict, values that do not change per batch are set in advance
+        self._example_template = {
+            "images": None,
+            "input_ids": None,
+            "captions": None,  # for debug_dataset
+            "latents": None,
+            "image_keys": None,  # for debug_dataset
+            "loss_weights": self._loss_weights,
+        }
+
+        # キャプションからトークンIDへのキャッシュ、LRUで管理する / cache from caption to token IDs, managed by LRU
+        self._token_cache = OrderedDict()
+
+        # フォントやキャプションの選択に使う乱数生成器、DataLoaderのプロセスごとに初期化する / random generator for choosing fonts and captions, initialized for each DataLoader process
+        self._rng = None
+        self._rng_seed = None
+
         # シャッフルのためのインデックスを用意 / prepare index for shuffle
-        self._indices = list(range(len(self._letters)))
+        self._indices = np.arange(len(self._letters), dtype=np.int32)
+        self._shuffled_epoch = None
 
         # メタデータを用意 / prepare metadata
         self.img_count = len(self._letters)
@@ -101,58 +194,132 @@ class JoyoKanjiDataset(MinimalDataset):
         # この関数は各エポックの最初に呼ばれる / This function is called at the beginning of each epoch
         # Datasetがマルチプロセスで動くので、ランダムシードを設定してシャッフルすることで、各プロセスで同じ順番でデータを処理するようにする
         # Dataset runs in multiprocess, so set a random seed and shuffle to process the data in the same order in each process
-        self._indices.sort()
-        rnd_state = random.getstate()
-        random.seed(JoyoKanjiDataset.SEED + epoch)
-        random.shuffle(self._indices)
-        random.setstate(rnd_state)
+        # バッチのindexはDataLoaderのsamplerが各workerに振り分けるので、_indicesをworkerごとに分割してはいけない
+        # 全workerで同じ順番にしておけば、各バッチは重複しない文字の範囲を担当する
+        # batch indices are distributed to workers by the DataLoader sampler, so _indices must not be split per worker
+        # with the same order in all workers, each batch covers a disjoint range of letters
+        # グローバルな乱数の状態を変えないように専用の乱数生成器を使う / use a dedicated random generator not to change the state of the global random
+        # collaterからバッチごとに呼ばれるので、エポックが変わったときだけシャッフルする / called for each batch from collater, so shuffle only when the epoch changes
+        if epoch != self._shuffled_epoch:
+            shuffle_rng = np.random.default_rng(JoyoKanjiDataset.SEED + epoch)
+            self._indices = shuffle_rng.permutation(len(self._letters)).astype(np.int32)
+            self._shuffled_epoch = epoch
 
         return super().set_current_epoch(epoch)
 
+    def _render_glyph(self, letter_index, font_index):
+        letter = self._letters[letter_index]
+        font = self._fonts[font_index]
+
+        # グレースケールで描画する、値はそのまま文字の濃さになる / draw in grayscale, the value is the coverage of the letter
+        img = Image.new("L", (self._render_size, self._render_size), color=0)
+        draw = ImageDraw.Draw(img)
+
+        # 事前に計算した位置に描画 / draw at the precomputed position
+        x, y = self._draw_origins[letter_index, font_index].tolist()
+        draw.text((x, y), letter, font=font, fill=255)
+
+        # 文字のある範囲だけを切り出す、縮小後の画素の境界に揃える / crop only the area with the letter, aligned to the pixel boundaries after downscaling
+        bbox = img.getbbox()
+        if bbox is None:
+            bbox = (0, 0, 0, 0)  # 空白文字 / blank letter
+        scale = self._render_scale
+        left, top = bbox[0] // scale, bbox[1] // scale
+        right, bottom = -(-bbox[2] // scale), -(-bbox[3] // scale)
+        mask = np.asarray(img.crop((left * scale, top * scale, right * scale, bottom * scale)))
+
+        # 学習時の解像度に縮小する、整数倍なのでINTER_AREAは単純な平均になる / downscale to the training resolution, INTER_AREA is a simple average since the factor is an integer
+        if scale > 1 and mask.size > 0:
+            mask = cv2.resize(mask, (right - left, bottom - top), interpolation=cv2.INTER_AREA)
+
+        return mask, (left, top)
+
+    def _render_images(self, letter_indices, font_indices):
+        if self._batch_buffer is None:
+            self._batch_buffer = np.zeros((JoyoKanjiDataset.BATCH_SIZE, self.height, self.width), dtype=np.uint8)
+        batch = self._batch_buffer
+
+        glyph_rects = self._glyph_table[letter_indices, font_indices].tolist()
+        for i in range(JoyoKanjiDataset.BATCH_SIZE):
+            # 前回描いた範囲を消してから文字を描く / clear the area drawn last time, then draw the letter
+            if self._batch_regions[i] is not None:
+                y, x, h, w = self._batch_regions[i]
+                batch[i, y : y + h, x : x + w] = 0
+            offset, y, x, h, w = glyph_rects[i]
+            batch[i, y : y + h, x : x + w] = self._glyph_masks[offset : offset + h * w].reshape(h, w)
+            self._batch_regions[i] = (y, x, h, w)
+
+        # バッファは使い回すので、返す画像は毎回新しく確保する / the buffer is reused, so allocate the returned images each time
+        # 白地に黒の画像への変換と正規化をまとめて行う、image_transformsと同じ結果になる: (255 - m) / 127.5 - 1 = 1 - m / 127.5
+        # convert to black on white and normalize at once, the result is the same as image_transforms: (255 - m) / 127.5 - 1 = 1 - m / 127.5
+        # 1チャンネルのバッファを3チャンネルにブロードキャストする / broadcast the 1-channel buffer to 3 channels
+        images = np.empty((JoyoKanjiDataset.BATCH_SIZE, 3, self.height, self.width), dtype=np.float32)
+        np.multiply(batch[:, None], np.float32(-1 / 127.5), out=images)
+        images += np.float32(1.0)
+        return torch.from_numpy(images)
+
+    def _get_rng(self):
+        # workerではtorch.initial_seed()がworkerごとに異なる値になるので、それをシードにする
+        # torch.initial_seed() differs for each worker, so use it as the seed
+        seed = torch.initial_seed()
+        if self._rng is None or self._rng_seed != seed:
+            self._rng = np.random.default_rng(seed)
+            self._rng_seed = seed
+        return self._rng
+
+    def _get_input_ids_cached(self, caption):
+        input_ids = self._token_cache.get(caption)
+        if input_ids is not None:
+            self._token_cache.move_to_end(caption)
+            return input_ids
+
+        # torch.stackでコピーされるので、キャッシュしたTensorをそのまま返してよい / torch.stack copies, so the cached tensor can be returned as is
+        input_ids = self.get_input_ids(caption)
+        self._token_cache[caption] = input_ids
+        if len(self._token_cache) > JoyoKanjiDataset.TOKEN_CACHE_SIZE:
+            self._token_cache.popitem(last=False)
+        return input_ids
+
     def __getitem__(self, index):
         image_keys = []
-        images = []
         captions = []
         input_ids_list = []
 
-        for i in range(JoyoKanjiDataset.BATCH_SIZE):
-            letter_index = index * JoyoKanjiDataset.BATCH_SIZE + i
+        # バッチ分の乱数をまとめて生成する / generate random numbers for the whole batch at once
+        rng = self._get_rng()
+        font_indices = rng.integers(0, len(self._fonts), JoyoKanjiDataset.BATCH_SIZE).tolist()
+        preposition_indices = rng.choice(
+            len(JoyoKanjiDataset.PREPOSITIONS), JoyoKanjiDataset.BATCH_SIZE, p=JoyoKanjiDataset.PREPOSITION_PROBS
+        ).tolist()
+        article_indices = rng.integers(0, len(JoyoKanjiDataset.ARTICLES), JoyoKanjiDataset.BATCH_SIZE).tolist()
+        letter_firsts = rng.integers(0, 2, JoyoKanjiDataset.BATCH_SIZE).tolist()
 
+        start = index * JoyoKanjiDataset.BATCH_SIZE
+        end = start + JoyoKanjiDataset.BATCH_SIZE
+        if end <= len(self._letters):
+            # 最後以外のバッチはそのまま切り出す / batches other than the last are just sliced
+            letter_indices = self._indices[start:end]
+        else:
             # 最後のバッチはBATCH_SIZEに満たない場合があるので、ランダムに文字を選ぶ / The last batch may not be full, so choose a character at random
-            if letter_index >= len(self._letters):
-                letter_index = random.randint(0, len(self._letters) - 1)
-            letter_index = self._indices[letter_index]
+            random_positions = rng.integers(0, len(self._letters), end - len(self._letters))
+            letter_indices = np.concatenate([self._indices[start:], self._indices[random_positions]])
+        letters = self._letters_arr[letter_indices].tolist()
 
-            letter = self._letters[letter_index]
+        for i in range(JoyoKanjiDataset.BATCH_SIZE):
+            letter = letters[i]
 
             # ランダムにフォントを選ぶ / Choose a font at random
-            font_index = random.randint(0, len(self._fonts) - 1)
-            font = self._fonts[font_index]
-
-            # 画像を生成 / Generate image
-            img = Image.new("RGB", (self.width, self.height), color=(255, 255, 255))
-            draw = ImageDraw.Draw(img)
-
-            # テキストサイズを計算して中央に描画 / Calculate text size and draw in the center
-            text_size = draw.textsize(letter, font=font)
-            y_offset = self._font_offsets[font_index]
-            draw.text(
-                ((self.width - text_size[0]) // 2, (self.height - text_size[1] + y_offset) // 2 - y_offset),
-                letter,
-                font=font,
-                fill=(0, 0, 0),
-            )
+            font_index = font_indices[i]
 
             # キャプションを生成 / Generate caption
-            cap_fragments = []
-            preposition = "by" if random.random() < 0.33 else ("with" if random.random() < 0.5 else "in")
-            article = "" if random.random() < 0.5 else "the"
-            cap_fragments.append(f"{preposition} {JoyoKanjiDataset.FONT_NAMES[font_index]}")
-            cap_fragments.append(f"{article} letter {letter}") # characterのほうがいいかも…… / character might be better...
+            font_fragment = self._font_fragments[preposition_indices[i]][font_index]
+            letter_fragment = self._letter_fragments[article_indices[i]] + letter
 
-            # キャプションをシャッフルして連結する / Shuffle and concatenate captions
-            random.shuffle(cap_fragments)
-            caption = ", ".join(cap_fragments)
+            # 順番をランダムにして連結する / Concatenate in random order
+            if letter_firsts[i]:
+                caption = letter_fragment + ", " + font_fragment
+            else:
+                caption = font_fragment + ", " + letter_fragment
 
             # Textual Inversionの場合は、captionにtoken_stringを含んでおき、以下を実行すると行けるはず
             # For Textual Inversion, include token_string in caption and execute the following
@@ -167,26 +334,21 @@ class JoyoKanjiDataset(MinimalDataset):
             #         caption = caption.replace(str_from, str_to)
 
             # トークンIDを取得 / Get token IDs
-            input_ids = self.get_input_ids(caption)
+            input_ids = self._get_input_ids_cached(caption)
 
             # バッチに追加 / Add to batch
-            img_tensor = self.image_transforms(img)
             image_keys.append(letter)
-            images.append(img_tensor)
             captions.append(caption)
             input_ids_list.append(input_ids)
 
+        # 文字画像をバッファに描いてTensorにする / draw the letter images to the buffer and convert to Tensor
+        images = self._render_images(letter_indices, font_indices)
+
         # ListからTensorに変換して返す / Convert from list to Tensor and return
-        images = torch.stack(images, dim=0)
         input_ids_list = torch.stack(input_ids_list, dim=0)
-        example = {
-            "images": images,
-            "input_ids": input_ids_list,
-            "captions": captions,
-            "latents": None,
-            "image_keys": image_keys, # for debug_dataset
-            # 1.0がデフォルトだが他の値を設定して重みづけを変えることもできる。数はバッチサイズと同じにすること
-            # 1.0 is the default, but you can also set other values to change the weighting. The number should be the same as the batch size.
-            "loss_weights": torch.ones(JoyoKanjiDataset.BATCH_SIZE, dtype=torch.float32),  
-        }
+        example = self._example_template.copy()
+        example["images"] = images
+        example["input_ids"] = input_ids_list
+        example["captions"] = captions
+        example["image_keys"] = image_keys
         return example